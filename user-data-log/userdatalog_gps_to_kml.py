@@ -3,10 +3,28 @@ import sys
 import csv
 import shutil
 from datetime import datetime
+from functools import lru_cache
 from string import Template
 
 METERS_PER_FOOT = 0.3048
 
+# number of CSV rows converted to KML and written to a session file at a time
+KML_BATCH_ROWS = 4096
+
+# size of the write buffer for each KML session file, in bytes
+KML_WRITE_BUFFER_SIZE = 1 << 20
+
+# the only user data log columns that are needed, everything else in a row is ignored
+CSV_COLUMNS = (
+    'Session Time',
+    'GPS Fix Quality',
+    'Number of Satellites',
+    'GPS Date & Time',
+    'Latitude (deg)',
+    'Longitude (deg)',
+    'GPS Altitude (feet)',
+)
+
 
 class Config:
 
@@ -20,9 +38,12 @@ class Config:
             setattr(self, k, v)
 
 
+@lru_cache(maxsize=8)
 def get_file_contents_as_string(filename: str) -> str:
     """
-    Read the entire contents of a file into a string and return it with newlines unchanged
+    Read the entire contents of a file into a string and return it with newlines unchanged.
+    Only used for the small KML template files, which don't change during a run, so the
+    contents are cached and each file is only read once.
     :param filename: name of the file to read
     :return: file contents as string
     """
@@ -31,6 +52,17 @@ def get_file_contents_as_string(filename: str) -> str:
         return f.read()
 
 
+def load_kml_templates(cfg):
+    """
+    Load the KML header and footer templates once, so they can be reused for every session file
+    :param cfg: configuration object
+    :return: nothing
+    """
+
+    cfg.kml_header_template = Template(get_file_contents_as_string(cfg.kml_template_header_filename))
+    cfg.kml_footer = get_file_contents_as_string(cfg.kml_template_footer_filename).encode()
+
+
 def configure_output_dir(cfg):
     """
     Configure the output directory (creating / deleting if necessary)
@@ -48,62 +80,12 @@ def configure_output_dir(cfg):
     print('')
 
 
-def get_session_list(cfg) -> list:
-    """
-    Build a list of all the sessions (identified by row numbers where the session starts),
-    as detected in the user data log. A new session is started whenever the session time
-    goes backwards, or the first row is read.
-    :param cfg: configuration object
-    :return: list of CSV rows were a new session was detected
-    """
-    print('Building session list...')
-
-    session_list = list()
-
-    csv_row_index = 0
-
-    # read a CSV file as a dictionary
-    with open(cfg.csv_input_filename, newline='') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-
-        last_session_time = -1.0
-
-        for csv_row in csv_reader:
-            # read the session times
-            session_time = csv_row['Session Time']
-
-            # continue if the session time is blank
-            if not session_time:
-                continue
-
-            # convert it to a number
-            session_time = float(session_time)
-
-            # if this is the first session or the session time went backwards,
-            # it must be a new session
-            if (csv_row_index == 0) or (session_time < last_session_time):
-                session_list.append(csv_row_index)
-
-            last_session_time = session_time
-            csv_row_index += 1
-
-        # add a final entry at the end so consumers know when to stop
-        # this final entry does not mark the start of a new session
-        session_list.append(csv_row_index)
-
-    # don't count the last, since it isn't really a session
-    session_count = len(session_list) - 1
-    print('Found {} sessions!'.format(session_count))
-
-    return session_list
-
-
 def open_kml_session_file(cfg, session_number):
     """
     Start a new KML session file based on the supplied session number.
     :param cfg: configuration object
     :param session_number: monotonically increasing session number suffix
-    :return: (KML file handle, KML filename)
+    :return: KML file handle
     """
 
     session_number = 'S' + str(session_number).zfill(3)
@@ -117,20 +99,19 @@ def open_kml_session_file(cfg, session_number):
     placemark_name = session_number
     description = session_number
 
-    kml_header_template = Template(get_file_contents_as_string(cfg.kml_template_header_filename))
-    kml_header_string = kml_header_template.substitute(
+    kml_header_string = cfg.kml_header_template.substitute(
         document_name=document_name,
         placemark_name=placemark_name,
         description=description,
     )
 
-    # open the KML file for writing
-    kml_file = open(kml_output_filename, 'w', newline='')
+    # open the KML file for writing, buffering enough that most sessions take only a few writes
+    kml_file = open(kml_output_filename, 'wb', buffering=KML_WRITE_BUFFER_SIZE)
 
     # write the KML header
-    kml_file.write(kml_header_string)
+    kml_file.write(kml_header_string.encode())
 
-    return kml_file, kml_output_filename
+    return kml_file
 
 
 def close_session_file(cfg, kml_file):
@@ -141,46 +122,90 @@ def close_session_file(cfg, kml_file):
     :return: nothing
     """
     # write the KML footer
-    kml_file.write(get_file_contents_as_string(cfg.kml_template_footer_filename))
+    kml_file.write(cfg.kml_footer)
 
     # close the file
     kml_file.close()
 
 
-def delete_session_file(kml_output_filename):
+def get_csv_column_index(csv_header) -> dict:
     """
-    Delete an existing KML session file
-    :param kml_output_filename: filename to delete
-    :return: nothing
+    Find where each of the needed columns is located in a row of the user data log.
+    :param csv_header: list of column names from the first row of the CSV file
+    :return: dictionary mapping column names to row positions, or None if a column is missing
+    """
+    missing_columns = [name for name in CSV_COLUMNS if name not in csv_header]
+    if missing_columns:
+        print('Missing CSV columns {}. Is this a user data log?'.format(missing_columns))
+        return None
+
+    return {name: csv_header.index(name) for name in CSV_COLUMNS}
+
+
+def write_kml_coordinate_batch(cfg, kml_file, session_number, csv_rows, generate_kml_coordinate_string) -> tuple:
+    """
+    Convert a batch of CSV rows to KML and write it to the current KML session file.
+    The session file is only created once there is data to write to it, so that sessions
+    without any usable rows never create (and then delete) a file.
+    :param cfg: configuration object
+    :param kml_file: KML file handle, or None if the session file hasn't been created yet
+    :param session_number: session number of the current session
+    :param csv_rows: list of CSV rows, each a list containing CSV row data
+    :param generate_kml_coordinate_string: function from make_kml_coordinate_generator
+    :return: (KML file handle or None, number of KML rows written)
     """
-    os.remove(kml_output_filename)
+
+    kml_string, kml_rows = generate_kml_coordinate_block(csv_rows, generate_kml_coordinate_string)
+
+    if kml_rows:
+        if kml_file is None:
+            kml_file = open_kml_session_file(cfg, session_number)
+
+        kml_file.write(kml_string.encode())
+
+    return kml_file, kml_rows
+
+
+def finish_session_file(cfg, kml_file, session_number, kml_rows_written) -> bool:
+    """
+    Finish the KML session file for a session, if one was created for it.
+    :param cfg: configuration object
+    :param kml_file: KML file handle, or None if no data was written for this session
+    :param session_number: session number of the session being finished
+    :param kml_rows_written: number of KML rows written to this session file
+    :return: True if a session file was written, False if the session was empty
+    """
+
+    if kml_file is None:
+        print('')
+        print('Skipping session {}, no data points'.format(session_number))
+        return False
+
+    # stop the current KML session file
+    close_session_file(cfg, kml_file)
+
+    print('Wrote {} data points'.format(kml_rows_written))
+
+    return True
 
 
 def convert_userdatalog_csv_to_kml(cfg):
     """
     Convert a SkyView User Data Log file to a series of KML files.
-    This is done in two passes.
-    First, read the CSV file to determine where the session boundaries are, and build an index.
-    Second, read the CSV file again and extract rows, convert to KML, and write to a KML file.
-    To be memory efficient, in the second pass, the CSV file is read at the same time as a KML
-    session file is being written, so as to not build up gigantic strings or lists of strings to
-    write to a file later.
+    This is done in a single pass over the CSV file. A new session is started whenever the
+    session time goes backwards, or the first row is read, so session boundaries are detected
+    while the rows are being converted to KML and written to the current KML session file.
+    To be memory efficient, the CSV file is read at the same time as a KML session file is
+    being written, so as to not build up gigantic strings or lists of strings to write to a
+    file later. Rows are converted and written in batches of KML_BATCH_ROWS at a time.
     :param cfg: configuration object
     :return: nothing
     """
 
     time_start = datetime.now()
 
-    # note: the last index in this list is not the start of a new session
-    # it only marks the end of the very last session
-    session_list = get_session_list(cfg)
-    if not session_list:
-        print('Empty session index. Is the input file empty?')
-        return
-
-    session_index = 0
     sessions_written = 0
-    sessions_detected = (len(session_list) - 1)
+    sessions_detected = 0
 
     empty_session_count = 0
     csv_row_index = 0
@@ -188,53 +213,99 @@ def convert_userdatalog_csv_to_kml(cfg):
     kml_rows_written_this_session = 0
     kml_rows_written_total = 0
 
-    # read a CSV file as a dictionary
-    with open(cfg.csv_input_filename, newline='') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
+    # read a CSV file as lists of fields, only looking at the columns we need
+    # the needed columns are plain ASCII, so decode as latin-1: a straight byte to character copy
+    # that is cheaper than the locale's codec and can't fail on stray bytes in other columns
+    with open(cfg.csv_input_filename, newline='', encoding='latin-1') as csv_file:
+        csv_reader = csv.reader(csv_file)
 
-        kml_file = None
-        kml_output_filename = ''
+        column_index = get_csv_column_index(next(csv_reader, []))
+        if column_index is None:
+            return
 
-        for csv_row in csv_reader:
+        # rows shorter than this are truncated and can't be used
+        csv_row_length = max(column_index.values()) + 1
+        session_time_index = column_index['Session Time']
 
-            # we are at the start of a new session
-            if session_list[session_index] == csv_row_index:
-                # start a new KML session file
-                kml_file, kml_output_filename = open_kml_session_file(cfg, session_index + 1)
+        generate_kml_coordinate_string = make_kml_coordinate_generator(cfg, column_index)
 
-            kml_string = generate_kml_coordinate_string(cfg, csv_row)
+        kml_file = None
 
-            if kml_string is None:
-                # None indicates a bad row that should be skipped
-                csv_rows_rejected += 1
-            else:
-                # write the data
-                kml_file.write(kml_string)
-                kml_rows_written_this_session += 1
-                kml_rows_written_total += 1
+        # rows of the current session waiting to be converted to KML
+        csv_row_batch = []
 
-            # the next row is a new session, so close this one
-            if session_list[session_index+1] == csv_row_index+1:
+        # looked up once here rather than on every row
+        add_to_batch = csv_row_batch.append
+        batch_rows = KML_BATCH_ROWS
 
-                # stop the current KML session file
-                close_session_file(cfg, kml_file)
-                sessions_written += 1
+        last_session_time = -1.0
 
-                suffix = ''
-                if kml_rows_written_this_session == 0:
-                    suffix = ', (deleting)'
-                    empty_session_count += 1
+        for csv_row in csv_reader:
 
-                    delete_session_file(kml_output_filename)
-                    sessions_written -= 1
+            # skip empty lines entirely, like csv.DictReader does
+            if not csv_row:
+                continue
 
-                print('Wrote {} data points{}'.format(kml_rows_written_this_session, suffix))
+            # skip truncated rows
+            if len(csv_row) < csv_row_length:
+                csv_rows_rejected += 1
+                csv_row_index += 1
+                continue
 
-                session_index += 1
-                kml_rows_written_this_session = 0
+            # if this is the first row or the session time went backwards,
+            # it must be a new session (blank session times never start one)
+            new_session = (sessions_detected == 0)
+
+            session_time = csv_row[session_time_index]
+            if session_time:
+                session_time = float(session_time)
+                if session_time < last_session_time:
+                    new_session = True
+                last_session_time = session_time
+
+            # write the batch at the end of a session, or once it is full
+            if csv_row_batch and (new_session or len(csv_row_batch) >= batch_rows):
+                kml_file, kml_rows = write_kml_coordinate_batch(
+                    cfg, kml_file, sessions_detected, csv_row_batch, generate_kml_coordinate_string)
+                csv_rows_rejected += len(csv_row_batch) - kml_rows
+                kml_rows_written_this_session += kml_rows
+                csv_row_batch.clear()
 
+            # we are at the start of a new session
+            if new_session:
+                # the previous session is done, so close it
+                if sessions_detected:
+                    if finish_session_file(cfg, kml_file, sessions_detected, kml_rows_written_this_session):
+                        sessions_written += 1
+                    else:
+                        empty_session_count += 1
+                    kml_rows_written_total += kml_rows_written_this_session
+                    kml_rows_written_this_session = 0
+
+                # the KML session file is created once the session has data to write
+                sessions_detected += 1
+                kml_file = None
+
+            add_to_batch(csv_row)
             csv_row_index += 1
 
+        # the end of the file also ends the last session
+        if sessions_detected:
+            kml_file, kml_rows = write_kml_coordinate_batch(
+                cfg, kml_file, sessions_detected, csv_row_batch, generate_kml_coordinate_string)
+            csv_rows_rejected += len(csv_row_batch) - kml_rows
+            kml_rows_written_this_session += kml_rows
+
+            if finish_session_file(cfg, kml_file, sessions_detected, kml_rows_written_this_session):
+                sessions_written += 1
+            else:
+                empty_session_count += 1
+            kml_rows_written_total += kml_rows_written_this_session
+
+    if not sessions_detected:
+        print('No sessions found. Is the input file empty?')
+        return
+
     time_end = datetime.now()
     duration_seconds = (time_end - time_start).total_seconds()
 
@@ -255,39 +326,71 @@ def convert_userdatalog_csv_to_kml(cfg):
     print('########################################')
 
 
-def generate_kml_coordinate_string(cfg, csv_row) -> str:
+def generate_kml_coordinate_block(csv_rows, generate_kml_coordinate_string) -> tuple:
+    """
+    Generate a block of KML coordinate strings from a batch of CSV rows, skipping bad rows.
+    :param csv_rows: list of CSV rows, each a list containing CSV row data
+    :param generate_kml_coordinate_string: function from make_kml_coordinate_generator
+    :return: (KML coordinate block, number of KML coordinates in the block)
+    """
+
+    kml_strings = [generate_kml_coordinate_string(csv_row) for csv_row in csv_rows]
+
+    # None indicates a bad row that should be skipped
+    kml_strings = [kml_string for kml_string in kml_strings if kml_string is not None]
+
+    return ''.join(kml_strings), len(kml_strings)
+
+
+def make_kml_coordinate_generator(cfg, column_index):
     """
-    Generate a KML coordinate string from a row of CSV data.
+    Build the function that generates a KML coordinate string from a row of CSV data.
+    The quality thresholds and column positions are fixed for a run, so they are bound into
+    the function once here instead of being looked up for every row.
     :param cfg: configuration object
-    :param csv_row: OrderedDict containing CSV row data
-    :return: a KML coordinate string in lat,lon,alt(m) format
+    :param column_index: dictionary mapping CSV column names to row positions
+    :return: function generating a KML coordinate string from a CSV row
     """
 
-    fix_quality = csv_row['GPS Fix Quality']
-    num_sats = csv_row['Number of Satellites']
-    date_and_time = csv_row['GPS Date & Time']
+    min_fix_quality = cfg.min_fix_quality
+    min_satellites = cfg.min_satellites
 
-    # skip the row if these entries are blank
-    if not fix_quality or not num_sats or not date_and_time:
-        return None
+    fix_quality_index = column_index['GPS Fix Quality']
+    num_sats_index = column_index['Number of Satellites']
+    date_and_time_index = column_index['GPS Date & Time']
+    lat_index = column_index['Latitude (deg)']
+    lon_index = column_index['Longitude (deg)']
+    alt_index = column_index['GPS Altitude (feet)']
 
-    # skip the row if the quality is low
-    if (int(fix_quality) < cfg.min_fix_quality) or (int(num_sats) < cfg.min_satellites):
-        return None
+    def generate_kml_coordinate_string(csv_row) -> str:
+        """
+        Generate a KML coordinate string from a row of CSV data.
+        :param csv_row: list containing CSV row data
+        :return: a KML coordinate string in lat,lon,alt(m) format
+        """
 
-    lat = csv_row['Latitude (deg)']
-    lon = csv_row['Longitude (deg)']
-    alt = csv_row['GPS Altitude (feet)']
+        # blank or malformed numbers fail to convert, which also skips the row
+        try:
+            # skip the row if the quality is low
+            if ((int(csv_row[fix_quality_index]) < min_fix_quality) or
+                    (int(csv_row[num_sats_index]) < min_satellites)):
+                return None
 
-    # skip the row if any of these fields are missing
-    if not lat or not lon or not alt:
-        return None
+            alt_meters = float(csv_row[alt_index]) * METERS_PER_FOOT
+        except ValueError:
+            return None
+
+        lat = csv_row[lat_index]
+        lon = csv_row[lon_index]
+
+        # skip the row if any of these fields are missing
+        if not lat or not lon or not csv_row[date_and_time_index]:
+            return None
 
-    # convert altitude from feet to meters
-    alt_meters = str(float(alt) * METERS_PER_FOOT)
+        # altitude is written to the nearest millimeter, lat and lon exactly as logged
+        return f'{lon},{lat},{alt_meters:.3f}\r\n'
 
-    kml_string = '{lon},{lat},{alt_meters}\r\n'.format(lon=lon, lat=lat, alt_meters=alt_meters)
-    return kml_string
+    return generate_kml_coordinate_string
 
 
 def main():
@@ -317,6 +420,7 @@ def main():
         min_satellites=4,
     )
 
+    load_kml_templates(cfg)
     configure_output_dir(cfg)
     convert_userdatalog_csv_to_kml(cfg)
 